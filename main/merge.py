@@ -1,11 +1,53 @@
 import argparse
+import contextlib
 import csv
+import functools
 import gzip
+import io
+import itertools
 import re
+import shutil
+import subprocess
+import tempfile
+
+import numpy as np
+import pandas as pd
 
 from pybedtools import BedTool
 
 
+GZIP_BUFFER_SIZE = 1 << 22
+
+CSV_BUFFER_SIZE = 1 << 20
+
+GTF_CHUNK_SIZE = 1 << 16
+
+GTF_COLUMNS = [
+    "chrom",
+    "source",
+    "feat",
+    "beg",
+    "end",
+    "score",
+    "strand",
+    "frame",
+    "meta_data"
+]
+
+_TYPE_RE = re.compile(r'\w{2}(?==)')
+
+# Only the leading word characters of a value are kept, e.g., a versioned
+# `ENSG00000223972.5` is read as `ENSG00000223972`; a tag with no such value
+# is missing, i.e., `None`.
+_GENE_ID_RE = re.compile(r'gene_id "(\w+)')
+_GENE_BIOTYPE_RE = re.compile(r'gene_biotype "(\w+)')
+
+# Exon type indexed by `4 * b + 2 * e + p`, where `b` and `e` indicate whether
+# the exon shares the transcript's beginning and end, respectively, and `p`
+# whether it is on the `+` strand.
+_EXON_TYPE = np.array(["IE", "IE", "FE", "LE", "LE", "FE", "SE", "SE"])
+
+
 def merge_exome(gtf_fp: str, out_fp: str):
     """Merges overlapping exon features within genes.
 
@@ -19,38 +61,47 @@ def merge_exome(gtf_fp: str, out_fp: str):
     exome = read_exome(gtf_fp)
     exome_merged = exome.merge(c=[4, 5, 6], o='distinct')
 
-    with open(out_fp, 'w') as f:
-        writer = csv.writer(f)
-        writer.writerow([
-            "gene_id",
-            "gene_biotype",
-            "chrom",
-            "meta_beg",
-            "meta_end",
-            "strand",
-            "meta_type",
-            "make_up"
-        ])
-
-        for row in exome_merged:
+    # Fields are written directly, rather than through `csv.writer`, which
+    # checks every field for quoting: `gene` and `func` are `\w+` or `None`
+    # (see `_GENE_ID_RE`), positions are integers, and `meta_type` is `_`-
+    # joined exon types, so only the fields `merge` collapses with
+    # `distinct` can need it — `make_up`, `chrom`, and `strand`, e.g., `+,-`
+    # when exons on both strands share field 1.
+    with (
+        open(exome_merged.fn) as bed,
+        open(out_fp, 'w', buffering=CSV_BUFFER_SIZE) as f
+    ):
+        f.write(
+            "gene_id,"
+            "gene_biotype,"
+            "chrom,"
+            "meta_beg,"
+            "meta_end,"
+            "strand,"
+            "meta_type,"
+            "make_up\r\n"
+        )
+
+        # The merged `.bed` is read as text, which is much cheaper than
+        # having `pybedtools` build an `Interval` per row.
+        for row in bed:
+            row = row.rstrip("\n").split("\t")
             gene_func, meta_beg, meta_end, make_up, chrom, strand = row
             gene, func = gene_func.split("=")
 
-            meta_type = "_".join(
-                sorted(set(re.findall(r'\w{2}(?==)', make_up)))
+            meta_type = _meta_type(make_up)
+
+            f.write(
+                f"{gene},"
+                f"{func},"
+                f"{_csv_field(chrom)},"
+                f"{meta_beg},"
+                f"{meta_end},"
+                f"{_csv_field(strand)},"
+                f"{meta_type},"
+                f"{_csv_field(make_up)}\r\n"
             )
 
-            writer.writerow([
-                gene,
-                func,
-                chrom,
-                meta_beg,
-                meta_end,
-                strand,
-                meta_type,
-                make_up
-            ])
-
 
 def read_exome(gtf_gz: str):
     """Reads exome from a `.gtf` file.
@@ -64,73 +115,164 @@ def read_exome(gtf_gz: str):
         without having run a separate merge operation on each gene, which is
         much slower.
     """
-    exome = str()
+    # Exons are written straight to a `.bed` file, rather than accumulated
+    # into a string, for `bedtools` to sort; this avoids holding the whole
+    # exome in memory and re-parsing it.
+    with (
+        tempfile.NamedTemporaryFile('w', suffix='.bed') as exome,
+        open_gtf(gtf_gz) as f
+    ):
+        # The last transcript seen, which may be in a previous chunk.
+        tran_pos = pd.DataFrame({"beg": [None], "end": [None]})
+
+        def read_rows():
+            return list(itertools.islice(f, GTF_CHUNK_SIZE))
+
+        for rows in iter(read_rows, []):
+            # Comments, and most rows, e.g., `gene`, `CDS`, or `UTR` features,
+            # are of no use here, so we discard them before `pandas` sees
+            # them.
+            rows = [
+                row for row in rows
+                if ("\texon\t" in row or "\ttranscript\t" in row)
+                and not row.startswith("#")
+            ]
+
+            if not rows:
+                continue
 
-    with gzip.open(gtf_gz, 'rt') as f:
-        tran_beg = None
-        tran_end = None
+            # The rows are parsed in `pandas` chunks rather than one by one;
+            # everything is kept as `str`, since positions are only compared
+            # and written back out, and nothing is read as NA, so contigs such
+            # as `NA` are left as they are.
+            chunk = pd.read_csv(
+                io.StringIO("".join(rows)),
+                sep="\t",
+                header=None,
+                names=GTF_COLUMNS,
+                usecols=["chrom", "feat", "beg", "end", "strand", "meta_data"],
+                dtype=str,
+                keep_default_na=False,
+                na_filter=False,
+                quoting=csv.QUOTE_NONE
+            )
 
-        for row in f:
-            if row.startswith("#"):
-                continue
+            chunk = chunk[chunk["feat"].isin(("transcript", "exon"))]
+            is_tran = chunk["feat"] == "transcript"
 
-            row = row.strip("\n").split("\t")
-            chrom, _, feat, *pos, _, strand, _, meta_data = row
+            # Each exon belongs to the closest transcript above it.
+            chunk_tran_pos = pd.concat([
+                tran_pos,
+                chunk[["beg", "end"]].where(is_tran)
+            ]).ffill()
 
-            beg, end = map(int, pos)
+            tran_pos = chunk_tran_pos.tail(1)
+            chunk_tran_pos = chunk_tran_pos.iloc[1:]
 
-            if feat == "transcript":
-                tran_beg = beg
-                tran_end = end
+            is_exon = ~is_tran.to_numpy()
+            exons = chunk[is_exon]
+            exon_tran_pos = chunk_tran_pos[is_exon]
 
+            if exons.empty:
                 continue
 
-            if feat == "exon":
-                gene = get_tag('gene_id', meta_data)
-                func = get_tag('gene_biotype', meta_data)
+            meta_data = exons["meta_data"]
+            gene = meta_data.str.extract(_GENE_ID_RE, expand=False)
+            func = meta_data.str.extract(_GENE_BIOTYPE_RE, expand=False)
 
-                boundary_match = int(beg == tran_beg), int(end == tran_end)
+            beg, end = exons["beg"], exons["end"]
 
-                if boundary_match == (1, 1):
-                    exon_type = "SE"
+            beg_match = beg.to_numpy() == exon_tran_pos["beg"].to_numpy()
+            end_match = end.to_numpy() == exon_tran_pos["end"].to_numpy()
+            plus = exons["strand"].to_numpy() == "+"
 
-                if boundary_match == (1, 0):
-                    exon_type = "FE" if strand == "+" else "LE"
+            exon_type = pd.Series(
+                _EXON_TYPE[4 * beg_match + 2 * end_match + plus],
+                index=exons.index
+            )
 
-                if boundary_match == (0, 1):
-                    exon_type = "LE" if strand == "+" else "FE"
+            pd.DataFrame({
+                "name": gene.fillna("None") + "=" + func.fillna("None"),
+                "beg": beg,
+                "end": end,
+                "make_up": exon_type + "=" + beg + "-" + end,
+                "chrom": exons["chrom"],
+                "strand": exons["strand"],
+            }).to_csv(
+                exome,
+                sep="\t",
+                header=False,
+                index=False,
+                quoting=csv.QUOTE_NONE
+            )
 
-                if boundary_match == (0, 0):
-                    exon_type = "IE"
+        exome.flush()
 
-                exome += (
-                    f"{gene}={func}\t"
-                    f"{beg}\t"
-                    f"{end}\t"
-                    f"{exon_type}={beg}-{end}\t"
-                    f"{chrom}\t"
-                    f"{strand}\n"
-                )
+        # `sort` writes its own output, so `exome` can be removed after.
+        return BedTool(exome.name).sort()
 
-    return BedTool(exome, from_string=True).sort()
 
+@contextlib.contextmanager
+def open_gtf(gtf_gz: str):
+    """Opens a `.gtf.gz` file for reading as text.
 
-def get_tag(tag: str, meta_data: str):
-    """Parses the `attribute` field of a `.gtf` file.
+    Decompression is handed off to `pigz` or `zcat`, when either is on `PATH`,
+    which runs in a separate process and is much faster than the `gzip`
+    module; otherwise, we fall back to `gzip`, behind a large read buffer to
+    cut the per-call decompression overhead.
 
     Args:
-        tag: The name of an attribute tag in a `.gtf` file.
-        meta_data: The meta-data, i.e., attribute string, to parse.
+        gtf_gz: The `.gtf.gz` file path.
 
-    Returns:
-        The value for `tag`, or `None` when `tag` cannot be found.
+    Yields:
+        A text stream over the decompressed `.gtf` lines.
     """
-    match = re.search(rf'(?<={tag} ")\w+', meta_data)
+    decompressor = shutil.which('pigz') or shutil.which('zcat')
+
+    if decompressor is None:
+        with gzip.open(gtf_gz, 'rb') as raw:
+            buf = io.BufferedReader(raw, buffer_size=GZIP_BUFFER_SIZE)
+
+            with io.TextIOWrapper(buf, encoding='utf-8') as f:
+                yield f
+
+        return
+
+    proc = subprocess.Popen(
+        [decompressor, '-dc', gtf_gz],
+        stdout=subprocess.PIPE,
+        bufsize=1 << 20
+    )
+
+    try:
+        with io.TextIOWrapper(proc.stdout, encoding='utf-8') as f:
+            yield f
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
+def _csv_field(value: str) -> str:
+    # Quotes `value` as `csv.writer` would, i.e., with `csv.QUOTE_MINIMAL`.
+    if any(char in value for char in ',"\r\n'):
+        value = value.replace('"', '""')
+        return f'"{value}"'
+
+    return value
+
+
+def _meta_type(make_up: str) -> str:
+    # `make_up` holds exon positions, so it is almost never repeated, but the
+    # set of exon types in it is one of only a handful.
+    return _join_exon_types(frozenset(_TYPE_RE.findall(make_up)))
+
 
-    if match:
-        return match.group(0)
-    else:
-        return None
+@functools.cache
+def _join_exon_types(exon_types: frozenset) -> str:
+    return "_".join(sorted(exon_types))
 
 
 if __name__ == "__main__":
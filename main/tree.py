@@ -1,6 +1,20 @@
 import ete3
+import numpy as np
 
-from itertools import combinations
+
+MAX_AMBIGUOUS_NODES = 10
+
+FITCH_CACHE_SIZE = 1 << 14
+
+# Fitch state sets are stored as bitmasks, where bit `i` is set when state `i`
+# is in the set, i.e., `{0}` is `0b01`, `{1}` is `0b10`, and `{0, 1}` is
+# `0b11`, so that intersections and unions are single `&` and `|` operations.
+STATE_0 = 0b01
+STATE_1 = 0b10
+STATE_AMBIGUOUS = STATE_0 | STATE_1
+
+# `fitch` outcomes, oldest first; see `fitch`.
+_FITCH_CACHE = dict()
 
 
 def get_node_age(tree: ete3.Tree):
@@ -18,9 +32,99 @@ def get_node_age(tree: ete3.Tree):
     return node_age
 
 
-def fitch(tree: ete3.Tree):
+def fitch(tree: ete3.Tree, max_ambiguous_nodes: int = MAX_AMBIGUOUS_NODES):
     tree_cp = tree.copy('deepcopy')
-    return _fitch(tree_cp)
+
+    for leaf in tree_cp:
+        # Leaves come in with `set` states; see `STATE_0` and `STATE_1`.
+        leaf.state = sum(1 << state for state in leaf.state)
+
+    # The outcome depends only on the topology and the leaf states, which
+    # repeat across many sites, so it's cached on both, as well as on the
+    # cutoff, which decides whether ambiguous trees are annotated at all.
+    key = max_ambiguous_nodes, tuple(
+        (node.name, len(node.children), node.state if node.is_leaf() else 0)
+        for node in tree_cp.traverse('preorder')
+    )
+
+    if key in _FITCH_CACHE:
+        # Re-inserted to mark it as the most recently used.
+        outcome = _FITCH_CACHE[key] = _FITCH_CACHE.pop(key)
+    else:
+        outcome = _FITCH_CACHE[key] = _fitch(tree_cp, max_ambiguous_nodes)
+
+        if len(_FITCH_CACHE) > FITCH_CACHE_SIZE:
+            del _FITCH_CACHE[next(iter(_FITCH_CACHE))]
+
+    min_changes, inner_state, solutions = outcome
+    return min_changes, _annotate_trees(tree_cp, inner_state, solutions)
+
+
+def clear_fitch_cache() -> None:
+    _FITCH_CACHE.clear()
+
+
+def fitch_min_changes(tree: ete3.Tree, leaf_states: dict) -> np.ndarray:
+    """Counts the minimum changes for many binary characters at once.
+
+    This runs only the first Fitch pass, over a `(node, character)` array of
+    state bitmasks, so every character is scored by the same `numpy`
+    operation at each node.
+
+    Args:
+        tree: The tree to score the characters on.
+        leaf_states: A mapping from leaf name to an array-like of states, one
+            per character, where `-1` marks missing data; leaves left out are
+            missing for every character.
+
+    Returns:
+        The minimum number of changes for each character.
+
+    Raises:
+        ValueError: If `leaf_states` is empty, or its leaves don't all have
+            the same number of characters.
+    """
+    no_chars = {len(states) for states in leaf_states.values()}
+
+    if not no_chars:
+        raise ValueError("`leaf_states` is empty.")
+
+    if len(no_chars) > 1:
+        raise ValueError(
+            "Every leaf in `leaf_states` must have the same number of "
+            f"characters; found {sorted(no_chars)}."
+        )
+
+    no_chars, = no_chars
+    nodes = list(tree.traverse('postorder'))
+    node_index = {node: i for i, node in enumerate(nodes)}
+
+    # Missing data is ambiguous, which never adds a change, i.e., it is the
+    # same as pruning the leaf.
+    states = np.full((len(nodes), no_chars), STATE_AMBIGUOUS, dtype=np.uint8)
+    min_changes = np.zeros(no_chars, dtype=np.int64)
+
+    for i, node in enumerate(nodes):
+        if node.is_leaf():
+            if node.name in leaf_states:
+                leaf_state = np.asarray(leaf_states[node.name])
+                states[i] = np.select(
+                    [leaf_state == 0, leaf_state == 1],
+                    [STATE_0, STATE_1],
+                    STATE_AMBIGUOUS
+                )
+
+            continue
+
+        desc_states = states[[node_index[desc] for desc in node.children]]
+        shared_state = np.bitwise_and.reduce(desc_states, axis=0)
+        union_state = np.bitwise_or.reduce(desc_states, axis=0)
+
+        no_shared_state = shared_state == 0
+        states[i] = np.where(no_shared_state, union_state, shared_state)
+        min_changes += no_shared_state
+
+    return min_changes
 
 
 def viz(tree: ete3.Tree, save_as: str) -> None:
@@ -35,122 +139,183 @@ def viz(tree: ete3.Tree, save_as: str) -> None:
 
     for node in tree.traverse('preorder'):
         if node.is_leaf():
-            node.add_face(ete3.TextFace(node.name), column=0)
-            node.add_face(ete3.TextFace(node.state), column=0)
-
-        if node.state == {1}:
-            node.set_style(pos_node_style)
+            label = f"{node.name}\n{_state_set(node.state)}"
+            node.add_face(ete3.TextFace(label), column=0)
 
+        # A gain takes precedence over the state it gives rise to.
         if node.gain:
             node.set_style(ori_node_style)
+        elif node.state == STATE_1:
+            node.set_style(pos_node_style)
 
     # tree.show(tree_style=tree_style)
     tree.render(save_as, w=6, units="in", tree_style=tree_style)
 
 
-def _fitch(tree: ete3.Tree):
-    annot_trees = set()
+def _fitch(
+    tree: ete3.Tree, max_ambiguous_nodes: int = MAX_AMBIGUOUS_NODES
+):
+    # The most parsimonious assignments, kept as their changes rather than as
+    # annotated trees; see `_annotate_trees`.
+    solutions = list()
 
     min_changes = _fitch_pass1(tree)
     ambiguous_nodes = _fitch_pass2(tree)
 
+    # Nodes are referred to by their preorder position rather than by name,
+    # since names needn't be unique, e.g., unlabeled inner nodes are all `''`.
+    nodes = list(tree.traverse('preorder'))
+    node_index = {node: i for i, node in enumerate(nodes)}
+
+    inner_state = [
+        None if node.is_leaf() else (node.state, node.operation)
+        for node in nodes
+    ]
+
+    pseudo_root = _get_pseudo_root(tree)
+    if pseudo_root.state == STATE_1:
+        # If the origin was assigned to the root, the true origin is unknown;
+        # it could be more ancestral than the common ancestor.
+        return min_changes, inner_state, solutions
+
     if ambiguous_nodes:
-        r = len({node for node, _ in ambiguous_nodes})
+        ambiguous_indices = list(dict.fromkeys(
+            node_index[node] for node, _ in ambiguous_nodes
+        ))
+        r = len(ambiguous_indices)
 
-        if r > 10:
+        if r > max_ambiguous_nodes:
             # Ignore — accounts for a minority of cases and becomes too time-
             # consuming.
-            return min_changes, annot_trees
-
-        for tree_state in combinations(ambiguous_nodes, r=r):
-            if not _unique_nodes(tree_state):
-                continue
-
-            node_state = {node.name: state for node, state in tree_state}
+            return min_changes, inner_state, solutions
+
+        # The topology is flattened once up front, so the enumeration below
+        # reads plain lists rather than traversing `tree`.
+        inner_indices = [
+            i for i, node in enumerate(nodes) if not node.is_leaf()
+        ]
+        inner_is_root = [nodes[i].is_root() for i in inner_indices]
+        inner_desc_indices = [
+            [node_index[desc] for desc in nodes[i].children]
+            for i in inner_indices
+        ]
+
+        # `STATE_0` and `STATE_1` shift down to 0 and 1; ambiguous nodes are
+        # overwritten by each assignment below.
+        base_state = [node.state >> 1 for node in nodes]
+
+        # Each of the `2^r` state assignments to the ambiguous nodes is
+        # encoded by the bits of `tree_state`.
+        for tree_state in range(1 << r):
+            node_state = {
+                node_i: (tree_state >> i) & 1
+                for i, node_i in enumerate(ambiguous_indices)
+            }
+
+            all_state = base_state.copy()
+            for node_i, state in node_state.items():
+                all_state[node_i] = state
 
             changes = {'gain': set(), 'loss': set()}
             tot_changes = 0
 
-            for node in tree.traverse('preorder'):
-                node_name = node.name
-
-                if node.is_leaf():
-                    continue
-
-                if node_name in node_state:
-                    state = node_state[node_name]
-                else:
-                    state, = node.state
+            for node_i, is_root, desc_indices in zip(
+                inner_indices, inner_is_root, inner_desc_indices
+            ):
+                state = all_state[node_i]
 
-                if node.is_root() and state == 1:
+                if is_root and state == 1:
                     # Here, the assignment of state 1 to the root is a de
                     # novo gain we've introduced, but it won't be counted
                     # below because there is no more ancestral 0 from which
                     # to track the change as a gain, so we increment the
                     # introduce change manually.
                     tot_changes += 1
-                    changes['gain'].add(node.name)
+                    changes['gain'].add(node_i)
 
-                for desc in node.children:
-                    desc_name = desc.name
+                for desc_i in desc_indices:
+                    desc_state = all_state[desc_i]
 
-                    if desc_name in node_state:
-                        desc_state = node_state[desc_name]
-                    else:
-                        desc_state, = desc.state
-
-                    match [state, desc_state]:
-                        case [0, 1]:
-                            changes['gain'].add(desc_name)
-                            tot_changes += 1
-                        case [1, 0]:
-                            changes['loss'].add(desc_name)
-                            tot_changes += 1
-                        case _:
-                            continue
+                    if state == desc_state:
+                        continue
 
-            if tot_changes == min_changes:
-                tree_cp = tree.copy('deepcopy')
-
-                for node in tree_cp.traverse('postorder'):
-                    name = node.name
+                    if desc_state:
+                        changes['gain'].add(desc_i)
+                    else:
+                        changes['loss'].add(desc_i)
 
-                    if name in changes['gain']:
-                        node.gain = True
+                    tot_changes += 1
 
-                    if name in changes['loss']:
-                        node.loss = True
+                    if tot_changes > min_changes:
+                        break
 
-                    # `node` was ambiguous and assigned a state; annotate the
-                    #  tree accordingly.
-                    if name in node_state:
-                        state = node_state[name]
-                        node.state = {state}
+                if tot_changes > min_changes:
+                    # Not most parsimonious; no need to score the rest.
+                    break
 
-                annot_trees.add(tree_cp)
+            if tot_changes == min_changes:
+                solutions.append((changes, node_state))
     else:
-        tree_cp = tree.copy('deepcopy')
+        changes = {'gain': set(), 'loss': set()}
 
-        for node in tree_cp.traverse(strategy='preorder'):
-            if node.state == {0}:
+        for node in nodes:
+            if node.state == STATE_0:
                 for desc in node.children:
-                    if desc.state == {1}:
-                        desc.gain = True
+                    if desc.state == STATE_1:
+                        changes['gain'].add(node_index[desc])
 
-            if node.state == {1}:
+            if node.state == STATE_1:
                 for desc in node.children:
-                    if desc.state == {0}:
-                        desc.loss = True
+                    if desc.state == STATE_0:
+                        changes['loss'].add(node_index[desc])
 
-        annot_trees.add(tree_cp)
+        solutions.append((changes, dict()))
 
-    pseudo_root = _get_pseudo_root(tree)
-    if pseudo_root.state == {1}:
-        # If the origin was assigned to the root, the true origin is unknown;
-        # it could be more ancestral than the common ancestor.
-        annot_trees = set()
+    return min_changes, inner_state, solutions
 
-    return min_changes, annot_trees
+
+def _annotate_trees(tree: ete3.Tree, inner_state: list, solutions: list):
+    annot_trees = set()
+
+    # On a cache hit, `tree` hasn't been through the Fitch passes, so their
+    # results, kept by preorder position, are set here.
+    for node, state in zip(tree.traverse('preorder'), inner_state):
+        node.gain = False
+        node.loss = False
+
+        if state is not None:
+            node.state, node.operation = state
+
+    if solutions:
+        # `tree` is a private copy, so the last solution is annotated on it
+        # directly and only the others pay for a copy of their own.
+        *other_solutions, last_solution = solutions
+
+        for solution in other_solutions:
+            tree_cp = tree.copy('deepcopy')
+            annot_trees.add(_annotate(tree_cp, *solution))
+
+        annot_trees.add(_annotate(tree, *last_solution))
+
+    return annot_trees
+
+
+def _annotate(tree: ete3.Tree, changes: dict, node_state: dict) -> ete3.Tree:
+    # `changes` and `node_state` refer to nodes by their preorder position.
+    for i, node in enumerate(tree.traverse('preorder')):
+        if i in changes['gain']:
+            node.gain = True
+
+        if i in changes['loss']:
+            node.loss = True
+
+        # `node` was ambiguous and assigned a state; annotate the tree
+        # accordingly.
+        if i in node_state:
+            state = node_state[i]
+            node.state = 1 << state
+
+    return tree
 
 
 def _fitch_pass1(tree: ete3.Tree) -> int:
@@ -163,15 +328,19 @@ def _fitch_pass1(tree: ete3.Tree) -> int:
         if node.is_leaf():
             continue
 
-        desc_states = [d.state for d in node.children]
-        shared_state = set.intersection(*desc_states)
+        shared_state = STATE_AMBIGUOUS
+        union_state = 0
+
+        for desc in node.children:
+            shared_state &= desc.state
+            union_state |= desc.state
 
         if shared_state:
             operation = '∩'
             state = shared_state
         else:
             operation = '∪'
-            state = set.union(*desc_states)
+            state = union_state
             min_changes += 1
 
         node.state = state
@@ -188,31 +357,43 @@ def _fitch_pass2(tree: ete3.Tree):
             continue
 
         if node.is_root():
-            if len(node.state) > 1:
+            if node.state == STATE_AMBIGUOUS:
                 ambiguous_nodes += [(node, state) for state in (0, 1)]
         else:
-            mra, *_ = node.get_ancestors()
+            mra = node.up
 
-            if mra.state.issubset(node.state):
+            if mra.state & node.state == mra.state:
+                # `mra.state` is a subset of `node.state`.
                 updated_state = node.state & mra.state
             else:
                 if node.operation == '∪':
                     updated_state = mra.state | node.state
                 else:
-                    desc_states = set.union(*[d.state for d in node.children])
+                    desc_states = 0
+
+                    for desc in node.children:
+                        desc_states |= desc.state
+
                     updated_state = node.state | (mra.state & desc_states)
 
             node.state = updated_state
-            if len(updated_state) > 1:
+            if updated_state == STATE_AMBIGUOUS:
                 ambiguous_nodes += [(node, state) for state in (0, 1)]
 
     return ambiguous_nodes
 
 
-def _unique_nodes(node_states):
-    return len({node for node, _ in node_states}) == len(node_states)
+def _get_pseudo_root(tree: ete3.Tree):
+    # The common ancestor of all the leaves is the first node below the root
+    # that branches, so there's no need to walk up from every leaf.
+    pseudo_root = tree
 
+    while len(pseudo_root.children) == 1:
+        pseudo_root, = pseudo_root.children
 
-def _get_pseudo_root(tree: ete3.Tree):
-    leaves = tree.get_leaf_names()
-    return tree.get_common_ancestor(leaves)
+    # As with `get_common_ancestor`, a lone leaf resolves to the root.
+    return tree if pseudo_root.is_leaf() else pseudo_root
+
+
+def _state_set(state: int) -> set:
+    return {i for i in (0, 1) if state >> i & 1}